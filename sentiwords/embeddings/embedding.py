@@ -4,10 +4,11 @@ author: Maurice Gercuk
 """
 import numpy as np
 import csv
+import json
 from nltk import ngrams
 from tqdm import tqdm
-from os.path import splitext, dirname
-from os import makedirs
+from os.path import splitext, dirname, exists, getmtime
+from os import makedirs, utime
 
 
 class Embedding():
@@ -29,13 +30,33 @@ class Embedding():
         self.embedding_matrix = None
 
     def load(self, load_path):
-        """Load embedding from a csv file in GloVe format.
+        """Load embedding from a csv file in GloVe format or from a .npy
+        file. A .npy embedding matrix is memory-mapped instead of read into
+        memory, its vocabulary is read from the .vocab file next to it.
+        When loading a csv, a .npy copy of it (and its words in row order)
+        is cached next to the csv, so later loads can use the memory-mapped
+        fast path.
         arguments:
-           load_path: Path to embedding csv.
+           load_path: Path to embedding csv or .npy file.
         """
+        if load_path.endswith('.npy'):
+            self._load_npy(load_path)
+            return
+
+        npy_path = splitext(load_path)[0] + '.npy'
+        words_path = splitext(load_path)[0] + '.words.json'
+        if (exists(npy_path) and exists(words_path)
+                and min(getmtime(npy_path), getmtime(words_path)) >=
+                getmtime(load_path)):
+            self._load_npy(npy_path)
+            return
+
         self.vocab_size = file_len(load_path)
+        words = []
 
-        with open(load_path, mode='r', newline='') as embedding_file:
+        with open(
+                load_path, mode='r', newline='',
+                encoding='utf-8') as embedding_file:
             reader = csv.reader(
                 embedding_file, delimiter=' ', quoting=csv.QUOTE_NONE)
             for index, embedding in tqdm(enumerate(reader)):
@@ -45,6 +66,34 @@ class Embedding():
                         (self.vocab_size, self.size), dtype=float)
                 self.vocabulary[embedding[0]] = index
                 self.embedding_matrix[index] = embedding[1:]
+                words.append(embedding[0])
+
+        try:
+            np.save(npy_path, self.embedding_matrix)
+            _save_words(words, words_path)
+        except OSError:
+            print('Could not cache embedding matrix at {}.'.format(npy_path))
+
+    def _load_npy(self, load_path):
+        """Memory-map an embedding matrix stored as .npy file and load the
+        corresponding vocabulary.
+        arguments:
+           load_path: Path to the .npy file. The vocabulary is read from the
+                      .words.json file next to it or, if there is none, from
+                      the .vocab file.
+        """
+        self.embedding_matrix = np.load(load_path, mmap_mode='r')
+        self.vocab_size, self.size = self.embedding_matrix.shape
+        words_path = splitext(load_path)[0] + '.words.json'
+        if exists(words_path):
+            # later duplicates win, just like when parsing the csv
+            self.vocabulary = {
+                word: index
+                for index, word in enumerate(_load_words(words_path))
+                if word is not None
+            }
+        else:
+            self.vocabulary = load_vocab(splitext(load_path)[0] + '.vocab')
 
     def initialize_embeddings_from_sentences(self, sentences):
         """Inititalize an embedding from sentences (tokenized).
@@ -90,25 +139,59 @@ class Embedding():
         """Save the embedding to file. Saves both a vocabulary file
         and a embedding csv in GloVe format. The vocabulary file is
         named like the embedding csv but with .vocab file extension.
+        Additionally, the embedding matrix is saved as .npy file, which
+        load memory-maps instead of parsing the csv.
 
         arguments:
            save_path: Path for output csv.
         """
-        makedirs(dirname(save_path), exist_ok=True)
-        with open(save_path, 'w', newline='') as save_file:
-            writer = csv.writer(
-                save_file,
-                delimiter=' ',
-                quoting=csv.QUOTE_NONE,
-                escapechar='',
-                quotechar='')
-            print('Writing embeddings to file...')
-            for word in sorted(
-                    self.vocabulary, key=lambda k: self.vocabulary[k]):
-                writer.writerow([word] + list(self.lookup([word])[0]))
-            print('Writing vocabulary to file...')
-            vocab_path = splitext(save_path)[0] + '.vocab'
-            save_vocab(self.vocabulary, vocab_path)
+        save_embedding_chunks(self.vocabulary, [self.embedding_matrix],
+                              self.embedding_matrix.shape, save_path)
+
+
+def save_embedding_chunks(vocab, chunks, shape, save_path):
+    """Save an embedding given as consecutive chunks of rows of its embedding
+    matrix, so that the whole matrix never has to be held in memory. Writes
+    the same files as Embedding.save: the embedding csv in GloVe format, the
+    vocabulary file and the .npy embedding matrix with its word list.
+
+    arguments:
+       vocab: vocabulary of the embedding. Dictionary of 'word: id'.
+       chunks: Iterable of arrays holding consecutive rows of the embedding
+               matrix.
+       shape: Shape of the whole embedding matrix.
+       save_path: Path for output csv.
+    """
+    makedirs(dirname(save_path) or '.', exist_ok=True)
+    # rows without a word are not written to the csv and stored as null in
+    # the word list
+    row_words = [None] * shape[0]
+    for word, index in vocab.items():
+        row_words[index] = word
+    npy_path = splitext(save_path)[0] + '.npy'
+    embedding_matrix = None
+    start = 0
+    with open(
+            save_path, 'w', buffering=1 << 20, encoding='utf-8') as save_file:
+        print('Writing embeddings to file...')
+        for chunk in chunks:
+            if embedding_matrix is None:
+                embedding_matrix = np.lib.format.open_memmap(
+                    npy_path, mode='w+', dtype=chunk.dtype, shape=tuple(shape))
+            embedding_matrix[start:start + len(chunk)] = chunk
+            words = row_words[start:start + len(chunk)]
+            save_file.writelines(
+                ' '.join([word] + [str(value) for value in row]) + '\n'
+                for row, word in zip(chunk, words) if word is not None)
+            start += len(chunk)
+    if embedding_matrix is not None:
+        embedding_matrix.flush()
+        del embedding_matrix
+        # mark the .npy as up to date with the csv (see Embedding.load)
+        utime(npy_path)
+    print('Writing vocabulary to file...')
+    save_vocab(vocab, splitext(save_path)[0] + '.vocab')
+    _save_words(row_words, splitext(save_path)[0] + '.words.json')
 
 
 def save_vocab(vocab, save_path):
@@ -120,7 +203,7 @@ def save_vocab(vocab, save_path):
        save_path: Path for output file.
     """
     sorted_vocab = sorted(vocab, key=lambda k: vocab[k])
-    with open(save_path, 'w') as output:
+    with open(save_path, 'w', encoding='utf-8') as output:
         for word in sorted_vocab:
             output.write(word + '\n')
 
@@ -132,12 +215,34 @@ def load_vocab(load_path):
     returns: Dictionary of 'word: id'.
     """
     vocabulary = dict()
-    with open(load_path) as vocabulary_file:
+    with open(load_path, encoding='utf-8') as vocabulary_file:
         for index, line in enumerate(vocabulary_file):
             vocabulary[line.strip()] = index
     return vocabulary
 
 
+def _save_words(words, save_path):
+    """Saves the words of an embedding matrix in row order as json list.
+    Unlike save_vocab, this keeps words with surrounding whitespace and
+    duplicate words intact.
+    arguments:
+       words: List of words, one for each row of the embedding matrix.
+       save_path: Path for output file.
+    """
+    with open(save_path, 'w', encoding='utf-8') as output:
+        json.dump(words, output, ensure_ascii=False)
+
+
+def _load_words(load_path):
+    """Load the words of an embedding matrix saved by _save_words.
+    arguments:
+       load_path: Path to words file.
+    returns: List of words in row order.
+    """
+    with open(load_path, encoding='utf-8') as words_file:
+        return json.load(words_file)
+
+
 def lookup_ids(vocabulary, words):
     """Lookup ids of given word in a vocabulary (dict of 'word: id').
     arguments:
@@ -158,7 +263,7 @@ def file_len(fname):
        fname: File to check for length.
     returns: Number of lines in input file.
     """
-    with open(fname) as f:
+    with open(fname, encoding='utf-8') as f:
         for i, l in enumerate(f):
             pass
     return i + 1
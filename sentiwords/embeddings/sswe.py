@@ -3,14 +3,19 @@ Includes custom input generator, model and commandline interface.
 author: Maurice Gerczuk
 """
 import csv
+import hashlib
+import numpy as np
+import pandas as pd
 import tensorflow as tf
 import argparse
+from functools import partial
 from ..processing.preprocessing import Preprocessor
-from .embedding import load_vocab, lookup_ids, Embedding
-from nltk import ngrams
-from random import randint
-from os.path import join
-from os import listdir
+from .embedding import load_vocab, save_embedding_chunks, Embedding
+from multiprocessing import Pool, cpu_count
+from glob import glob
+from os import makedirs, replace
+from os.path import (join, basename, splitext, exists, isdir, getmtime,
+                     getsize, dirname)
 
 # Set logging verbosity to INFO so that loss is printed to cmd during training.
 tf.logging.set_verbosity(tf.logging.INFO)
@@ -18,10 +23,11 @@ tf.logging.set_verbosity(tf.logging.INFO)
 
 class InputGenerator():
     """Input Generator for the SSWE model.
-    Extracts non-overlapping trigrams (of ngrams) from a given tweet csv.
-    It yields the vocabulary ids of this original tri-gram, those of a
-    corresponding corrupted tri-gram (the center word is replaced with a
-    random one) and a sentiment label.
+    Reads raw tweets and their sentiment labels from a given tweet csv.
+    Batches of these tweets are then turned into non-overlapping trigrams
+    (of ngrams): the vocabulary ids of the original tri-gram and a sentiment
+    label. Corresponding corrupted tri-grams (the center word is replaced
+    with a random one) are generated in the input_fn graph.
     """
 
     def __init__(
@@ -31,75 +37,264 @@ class InputGenerator():
             preprocessor=Preprocessor(),
             csv_delimiter=',',
             ngram=1,
-            csv_columns=['sentiment', 'id', 'date', 'status', 'user', 'text']):
+            csv_columns=['sentiment', 'id', 'date', 'status', 'user', 'text'],
+            chunk_size=10000):
         """Initialize the InputGenerator.
         arguments:
            input_path: Path to input csv.
-           vocab: Vocabulary to look up word ids.
+           vocab: Vocabulary to look up word ids. Out-of-vocabulary ngrams
+                  are mapped to '<unknown>' if the vocabulary contains it,
+                  otherwise they raise a KeyError.
            preprocessor: Preprocessor object for tokenizing input data.
            csv_delimiter: Delimiter used in the input_csv.
            ngram: Degree of ngram to be extracted from input data tweets.
            csv_columns: columns for the input data. 'text' column should
                         contain the raw tweets and 'sentiment' column the
-                        tweet polarity labels.
+                        tweet polarity labels. If None, the columns are read
+                        from the header of the input csv.
+           chunk_size: Number of csv rows that are parsed at once.
         """
-
-        input_file = open(input_path, 'r', encoding='utf-8')
-        self.reader = csv.reader(input_file, delimiter=csv_delimiter)
-        if csv_columns is None:
-            self.csv_columns = next(self.reader)
+        self.input_path = input_path
+        self.csv_delimiter = csv_delimiter
+        self.has_header = csv_columns is None
+        if self.has_header:
+            with open(input_path, 'r', encoding='utf-8') as input_file:
+                csv_columns = next(
+                    csv.reader(input_file, delimiter=csv_delimiter))
         self.preprocessor = preprocessor
         self.ngram = ngram
+        # unigrams need no joining, the tokens can be used as they are
+        self._extract_ngrams = list if ngram == 1 else self.extract_ngrams
         self.csv_columns = csv_columns
+        self.chunk_size = chunk_size
         self.vocab = vocab
-        self.samples = iter(self.generate_samples())
+        # without '<unknown>' every ngram has to be in the vocabulary
+        self._vocab_get = (vocab.get
+                           if '<unknown>' in vocab else self._strict_lookup)
+        self._unknown_id = vocab.get('<unknown>')
 
-    def generate_samples(self):
-        """Generate input samples of ((original tri-gram, corrupted tri-gram),
-        label). Samples are extracted from the tweets in a non-overlapping fashion.
+    def generate_tweets(self):
+        """Generate the raw tweets of the input csv together with their
+        sentiment labels. Every call reads the csv from the beginning, chunk
+        by chunk.
 
-        yields: A tuple of ((original_trigram, corrupted_trigram), label).
+        yields: A tuple of (tweet, label).
         """
-        for line in self.reader:
+        chunks = pd.read_csv(
+            self.input_path,
+            sep=self.csv_delimiter,
+            header=0 if self.has_header else None,
+            names=self.csv_columns,
+            usecols=['sentiment', 'text'],
+            dtype={'text': str},
+            keep_default_na=False,
+            encoding='utf-8',
+            chunksize=self.chunk_size)
+        for chunk in chunks:
+            # sentiment labels > 0 are considered positive (1) others negative
+            labels = np.where(chunk['sentiment'].values > 0, 1, -1)
+            yield from zip(chunk['text'].tolist(), labels.tolist())
 
-            # extract a list of non-overlapping ngrams from the tweet
-            current_tweet = list(
-                map('_'.join,
-                    ngrams(
-                        self.preprocessor.tokenize_tweet(
-                            line[self.csv_columns.index('text')]),
-                        self.ngram)))[::self.ngram]
+    def generate_samples(self, tweets, labels):
+        """Generate input samples of (original tri-gram, label) for a whole
+        batch of tweets. Samples are extracted from the tweets in a
+        non-overlapping fashion.
+        arguments:
+           tweets: List of raw tweets.
+           labels: Array of sentiment labels, one for each tweet.
+        returns: A tuple of (samples, labels) where samples is an int64 array
+                 of shape [num_samples, 3] holding the original tri-grams and
+                 labels an int64 array of shape [num_samples].
+        """
+        ids = []
+        sample_labels = []
+        # look up attributes once instead of once per ngram
+        vocab_get = self._vocab_get
+        unknown_id = self._unknown_id
+        for grams, label, num_chunks in self._tweet_trigrams(tweets, labels):
+            ids.extend([vocab_get(gram, unknown_id) for gram in grams])
+            sample_labels.extend([label] * num_chunks)
+        return (np.array(ids, dtype=np.int64).reshape(-1, 3),
+                np.array(sample_labels, dtype=np.int64))
+
+    def _strict_lookup(self, gram, default=None):
+        """Replacement for vocab.get for vocabularies without '<unknown>'.
+        arguments:
+           gram: Ngram to look up.
+           default: Ignored, there is no id to fall back to.
+        returns: The vocabulary id of the ngram.
+        """
+        try:
+            return self.vocab[gram]
+        except KeyError:
+            raise KeyError(
+                "'{}' is not in the vocabulary, which has no '<unknown>' "
+                "entry to fall back to.".format(gram)) from None
+
+    def generate_trigrams(self, tweets, labels):
+        """Generate input samples like generate_samples, but keep the ngrams
+        of the tri-grams instead of looking up their vocabulary ids. Used when
+        the ids are looked up in the graph (see vocabulary_table).
+        arguments:
+           tweets: List of raw tweets.
+           labels: Array of sentiment labels, one for each tweet.
+        returns: A tuple of (trigrams, labels) where trigrams is a string
+                 array of shape [num_samples, 3] and labels an int64 array of
+                 shape [num_samples].
+        """
+        trigrams = []
+        sample_labels = []
+        for grams, label, num_chunks in self._tweet_trigrams(tweets, labels):
+            trigrams.extend(grams)
+            sample_labels.extend([label] * num_chunks)
+        return (np.array(trigrams, dtype=str).reshape(-1, 3),
+                np.array(sample_labels, dtype=np.int64))
+
+    def _tweet_trigrams(self, tweets, labels):
+        """Tokenize a batch of tweets and extract the ngrams of their
+        non-overlapping tri-grams. Tweets without a complete tri-gram are
+        skipped.
+        arguments:
+           tweets: List of raw tweets.
+           labels: Array of sentiment labels, one for each tweet.
+        yields: A tuple of (ngrams, label, number of tri-grams) per tweet.
+        """
+        # look up attributes once instead of once per tweet
+        extract_ngrams = self._extract_ngrams
+        tokenized_tweets = self.preprocessor.tokenize_batch(tweets)
+        for tokens, label in zip(tokenized_tweets, labels):
 
-            # sentiment labels > 0 are considered positive (1) others negative
-            current_label = 1 if int(
-                line[self.csv_columns.index('sentiment')]) > 0 else -1
+            # extract a list of non-overlapping ngrams from the tweet
+            current_tweet = extract_ngrams(tokens)
 
             # group three neighboring ngrams together (without overlap)
-            chunks = (current_tweet[i * 3:(i + 1) * 3]
-                      for i in range(0, int(len(current_tweet) / 3)))
-            for current_chunk in chunks:
-                sample = lookup_ids(self.vocab, current_chunk)
-                yield (sample, self.corrupted_sample(sample)), current_label
-
-    def corrupted_sample(self, sample):
-        """Generate a corrupted sample from an input tri-gram. The middle word
-        is replaced by a random one.
+            num_chunks = len(current_tweet) // 3
+            if num_chunks == 0:
+                continue
+            yield current_tweet[:num_chunks * 3], label, num_chunks
+
+    def extract_samples(self, processes=None):
+        """Extract the samples of the whole input csv. The tweets are split
+        into one shard per process and the shards are processed in parallel
+        by generate_samples.
+        arguments:
+           processes: Number of worker processes. Defaults to the number of
+                      cpus.
+        returns: A tuple of (samples, labels) where samples is an int64 array
+                 of shape [num_samples, 3] holding the original tri-grams and
+                 labels an int64 array of shape [num_samples].
+        """
+        tweets = []
+        labels = []
+        for tweet, label in self.generate_tweets():
+            tweets.append(tweet)
+            labels.append(label)
+
+        processes = processes or cpu_count()
+        shard_size = max(1, int(np.ceil(len(tweets) / processes)))
+        shards = [(tweets[i:i + shard_size], labels[i:i + shard_size])
+                  for i in range(0, len(tweets), shard_size)]
+        if processes == 1 or len(shards) <= 1:
+            results = [self.generate_samples(*shard) for shard in shards]
+        else:
+            with Pool(
+                    processes,
+                    initializer=_init_shard_worker,
+                    initargs=(self, )) as pool:
+                results = pool.map(_process_shard, shards)
+        if not results:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(
+                0, dtype=np.int64)
+        samples, labels = zip(*results)
+        return np.concatenate(samples), np.concatenate(labels)
+
+    def extract_ngrams(self, tokens):
+        """Extract non-overlapping ngrams from a list of tokens. The tokens of
+        each ngram are joined with '_'.
         arguments:
-           sample: Input trigram.
-        returns: Corrupted trigram.
+           tokens: List of tokens.
+        returns: List of ngrams.
         """
-        random_word = randint(0, len(self.vocab) - 1)
-        while random_word == sample[1]:
-            random_word = randint(0, len(self.vocab) - 1)
-        return [sample[0], random_word, sample[2]]
+        n = self.ngram
+        return [
+            '_'.join(tokens[i:i + n])
+            for i in range(0, len(tokens) - n + 1, n)
+        ]
 
     def __iter__(self):
-        """Return an iterator (which objects of this class are)."""
-        return self
+        """Return an iterator over the (tweet, label) pairs of the csv."""
+        return self.generate_tweets()
 
-    def __next__(self):
-        """Standard method for iterators: Return next element."""
-        return next(self.samples)
+
+def _init_shard_worker(input_generator):
+    """Initializer of the preprocessing worker processes. Stores the
+    InputGenerator, so that it is only sent once to every worker.
+    arguments:
+       input_generator: InputGenerator used for extracting samples.
+    """
+    global _shard_generator
+    _shard_generator = input_generator
+
+
+def _process_shard(shard):
+    """Extract the samples of a shard of tweets in a worker process.
+    arguments:
+       shard: Tuple of (tweets, labels) lists.
+    returns: A tuple of (samples, labels) arrays as returned by
+             InputGenerator.generate_samples.
+    """
+    return _shard_generator.generate_samples(*shard)
+
+
+def corrupt_batch(samples, labels, vocabulary_size):
+    """Stack a batch of tri-grams with their corrupted counterparts. The
+    middle word is replaced by a random one that differs from the original.
+    arguments:
+       samples: int64 tensor of tri-grams with shape [batch_size, 3].
+       labels: Sentiment labels of the tri-grams.
+       vocabulary_size: Size of the vocabulary the random words are drawn from.
+    returns: A tuple of (samples, labels) where samples has shape
+             [batch_size, 2, 3] (original and corrupted tri-grams).
+    """
+    # draw from all but one id and skip over the original middle word
+    random_words = tf.random.uniform(
+        tf.shape(samples)[:1], maxval=vocabulary_size - 1, dtype=tf.int64)
+    random_words += tf.cast(random_words >= samples[:, 1], tf.int64)
+    corrupted = tf.stack([samples[:, 0], random_words, samples[:, 2]], axis=1)
+    return tf.stack([samples, corrupted], axis=1), labels
+
+
+def vocabulary_table(vocabulary):
+    """Build a lookup table that maps ngrams to their vocabulary ids inside
+    the graph. Ngrams missing from the vocabulary are mapped to the id of
+    '<unknown>', or to -1 if the vocabulary has no '<unknown>' entry.
+    arguments:
+       vocabulary: Dictionary of 'word: id'.
+    returns: A tf.lookup.StaticHashTable.
+    """
+    return tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            list(vocabulary.keys()),
+            list(vocabulary.values()),
+            key_dtype=tf.string,
+            value_dtype=tf.int64),
+        default_value=vocabulary.get('<unknown>', -1))
+
+
+class IteratorInitializerHook(tf.train.SessionRunHook):
+    """Hook that initializes a dataset iterator once the session has been
+    created. Needed for datasets that are fed through placeholders or that
+    use lookup tables.
+    """
+
+    def __init__(self):
+        """Initialize the hook. The initializer function is set by input_fn."""
+        super().__init__()
+        self.iterator_initializer_func = None
+
+    def after_create_session(self, session, coord):
+        """Initialize the iterator after the session has been created."""
+        self.iterator_initializer_func(session)
 
 
 def input_fn(csv,
@@ -111,8 +306,21 @@ def input_fn(csv,
              num_epochs=None,
              batch_size=32,
              csv_columns=['sentiment', 'id', 'date', 'status', 'user',
-                          'text']):
+                          'text'],
+             shuffle_buffer_size=None,
+             cache_path=None,
+             processes=None,
+             iterator_initializer_hook=None):
     """input_fn created from InputGenerator to be used with tf.Estimator.
+    All samples of the input csv are extracted up front by a pool of worker
+    processes and then sliced into a dataset. If a cache_path is given, the
+    extracted tri-grams are stored there, so that later runs skip reading
+    and tokenizing the csv. The cache is only used as long as the csv
+    (modification time and size), its delimiter and columns, the vocabulary
+    and ngram are unchanged. Corrupted tri-grams are generated per batch and
+    therefore differ between epochs. If an IteratorInitializerHook is given,
+    the samples are fed into the dataset through placeholders instead of
+    being stored as constants in the graph.
     arguments:
        csv: Path to input csv.
        vocab: Vocabulary to look up word ids.
@@ -125,24 +333,211 @@ def input_fn(csv,
        csv_columns: columns for the input data. 'text' column should
                     contain the raw tweets and 'sentiment' column the
                     tweet polarity labels.
+       shuffle_buffer_size: Number of samples the shuffle buffer holds.
+                            Defaults to all samples, but at most 1000000.
+       cache_path: Optional .npz filename for caching the extracted
+                   tri-grams.
+       processes: Number of processes used for extracting the samples.
+                  Defaults to the number of cpus.
+       iterator_initializer_hook: Optional IteratorInitializerHook that has
+                                  to be passed to the Estimator as well.
     returns: A tuple of features, labels where features is a dict containing
              both the original ngrams (key: 'original) and the corresponding
              corrupted ngrams (key: 'corrupted).
     """
     input_generator = InputGenerator(csv, vocabulary, preprocessor,
                                      csv_delimiter, ngram, csv_columns)
+    # the cache is only valid for the same csv, csv layout, ngram and
+    # vocabulary (words and their ids)
+    digest = hashlib.sha1(
+        repr((getmtime(csv), getsize(csv), ngram, csv_delimiter,
+              list(csv_columns))).encode('utf-8'))
+    for word, index in sorted(vocabulary.items(), key=lambda item: item[1]):
+        digest.update(repr((word, index)).encode('utf-8'))
+    cache_key = digest.hexdigest()
+    samples = None
+    if cache_path is not None and exists(cache_path):
+        with np.load(cache_path) as cache:
+            if 'key' in cache and str(cache['key']) == cache_key:
+                samples, labels = cache['samples'], cache['labels']
+    if samples is None:
+        samples, labels = input_generator.extract_samples(processes)
+        if cache_path is not None:
+            # the estimator only creates its model dir once training starts
+            makedirs(dirname(cache_path) or '.', exist_ok=True)
+            # write to a temporary file first so that an interrupted run
+            # never leaves a truncated cache behind
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as cache_file:
+                np.savez(
+                    cache_file, samples=samples, labels=labels, key=cache_key)
+            replace(tmp_path, cache_path)
+
+    vocabulary_size = len(vocabulary)
+
+    if iterator_initializer_hook is not None:
+        samples_placeholder = tf.placeholder(tf.int64, samples.shape)
+        labels_placeholder = tf.placeholder(tf.int64, labels.shape)
+        dataset = tf.data.Dataset.from_tensor_slices((samples_placeholder,
+                                                      labels_placeholder))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((samples, labels))
+    if shuffle:
+        if shuffle_buffer_size is None:
+            shuffle_buffer_size = min(len(samples), 1000000)
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+    dataset = dataset.repeat(num_epochs)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda samples, labels: corrupt_batch(samples, labels, vocabulary_size),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    if iterator_initializer_hook is not None:
+        iterator = dataset.make_initializable_iterator()
+
+        def initialize_iterator(session):
+            """Feed the extracted samples into the dataset."""
+            session.run(
+                iterator.initializer,
+                feed_dict={
+                    samples_placeholder: samples,
+                    labels_placeholder: labels
+                })
+
+        iterator_initializer_hook.iterator_initializer_func = \
+            initialize_iterator
+    else:
+        iterator = dataset.make_one_shot_iterator()
+    with tf.name_scope('input'):
+        features, labels = iterator.get_next()
+        return {
+            'original': features[:, 0],
+            'corrupted': features[:, 1]
+        }, labels
 
-    def gen():
-        for sample in input_generator:
-            yield sample
 
-    dataset = tf.data.Dataset.from_generator(
-        gen, output_types=(tf.int64, tf.int64), output_shapes=([2, 3], []))
+def streaming_input_fn(csv,
+                       vocabulary,
+                       iterator_initializer_hook,
+                       csv_delimiter=',',
+                       preprocessor=Preprocessor(),
+                       ngram=1,
+                       shuffle=True,
+                       num_epochs=None,
+                       batch_size=32,
+                       csv_columns=[
+                           'sentiment', 'id', 'date', 'status', 'user', 'text'
+                       ],
+                       shuffle_buffer_size=100000,
+                       cycle_length=None):
+    """input_fn that streams the input csv instead of extracting all samples
+    up front, for datasets that do not fit into memory. The input may be
+    split into several csv shards, which are read in parallel. The csv lines
+    are read with TextLineDatasets and parsed with tf.decode_csv. Batches of
+    tweets are tokenized into tri-grams of ngrams by a tf.py_func and the
+    ngrams are mapped to their ids by a lookup table in the graph.
+    arguments:
+       csv: Path to input csv, a directory of csv shards or a glob pattern
+            matching the shards. All shards need the same columns.
+       vocab: Vocabulary to look up word ids.
+       iterator_initializer_hook: IteratorInitializerHook that has to be
+                                  passed to the Estimator as well.
+       csv_delimiter: Delimiter used in the input_csv.
+       preprocessor: Preprocessor object for tokenizing input data.
+       ngram: Degree of ngram to be extracted from input data tweets.
+       shuffle: Whether input data should be shuffled.
+       num_epochs: How many times the input_fn should cycle through the data.
+       batch_size: How many elements to generate for one step.
+       csv_columns: columns for the input data. 'text' column should
+                    contain the raw tweets and 'sentiment' column the
+                    tweet polarity labels.
+       shuffle_buffer_size: Number of samples the shuffle buffer holds.
+       cycle_length: Number of shards that are read in parallel. Defaults to
+                     the number of shards, but at most the number of cpus.
+    returns: A tuple of features, labels where features is a dict containing
+             both the original ngrams (key: 'original) and the corresponding
+             corrupted ngrams (key: 'corrupted).
+    """
+    if isdir(csv):
+        csv = join(csv, '*')
+    shards = sorted(glob(csv))
+    if not shards:
+        raise ValueError('No csv shards found matching {}.'.format(csv))
+    # the columns (and header) are taken from the first shard
+    input_generator = InputGenerator(shards[0], vocabulary, preprocessor,
+                                     csv_delimiter, ngram, csv_columns)
+    text_column = input_generator.csv_columns.index('text')
+    sentiment_column = input_generator.csv_columns.index('sentiment')
+    select_columns = sorted([text_column, sentiment_column])
+    record_defaults = [[''] if column == text_column else [0]
+                       for column in select_columns]
+    table = vocabulary_table(vocabulary)
+    vocabulary_size = len(vocabulary)
+
+    def extract_trigrams(tweets, labels):
+        """Tokenize a batch of utf-8 encoded tweets into tri-grams."""
+        trigrams, labels = input_generator.generate_trigrams(
+            [tweet.decode('utf-8') for tweet in tweets], labels)
+        return np.char.encode(trigrams, 'utf-8'), labels
+
+    def parse_batch(lines):
+        """Turn a batch of csv lines into tri-gram samples."""
+        fields = dict(
+            zip(select_columns,
+                tf.decode_csv(
+                    lines,
+                    record_defaults,
+                    field_delim=csv_delimiter,
+                    select_cols=select_columns)))
+        # sentiment labels > 0 are considered positive (1) others negative
+        labels = 2 * tf.cast(fields[sentiment_column] > 0, tf.int64) - 1
+        trigrams, labels = tf.py_func(extract_trigrams,
+                                      [fields[text_column], labels],
+                                      [tf.string, tf.int64])
+        trigrams.set_shape([None, 3])
+        labels.set_shape([None])
+        ids = table.lookup(trigrams)
+        if '<unknown>' not in vocabulary:
+            check = tf.debugging.assert_non_negative(
+                ids,
+                message="An ngram is not in the vocabulary, which has no "
+                "'<unknown>' entry to fall back to.")
+            with tf.control_dependencies([check]):
+                ids = tf.identity(ids)
+        return ids, labels
+
+    def read_shard(shard):
+        """Read the lines of a csv shard (without header)."""
+        lines = tf.data.TextLineDataset(shard)
+        return lines.skip(1) if input_generator.has_header else lines
+
+    dataset = tf.data.Dataset.list_files(shards, shuffle=shuffle)
+    dataset = dataset.interleave(
+        read_shard,
+        cycle_length=cycle_length or min(len(shards), cpu_count()),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if shuffle:
+        # the order is shuffled anyway, so lines need not be read in order
+        options = tf.data.Options()
+        options.experimental_deterministic = False
+        dataset = dataset.with_options(options)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        parse_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.apply(tf.data.experimental.unbatch())
     if shuffle:
-        dataset = dataset.shuffle(buffer_size=10000)
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
     dataset = dataset.repeat(num_epochs)
     dataset = dataset.batch(batch_size)
-    iterator = dataset.make_one_shot_iterator()
+    dataset = dataset.map(
+        lambda samples, labels: corrupt_batch(samples, labels, vocabulary_size),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    # the lookup table can not be captured by a one-shot iterator
+    iterator = dataset.make_initializable_iterator()
+    iterator_initializer_hook.iterator_initializer_func = \
+        lambda session: session.run(iterator.initializer)
     with tf.name_scope('input'):
         features, labels = iterator.get_next()
         return {
@@ -151,6 +546,23 @@ def input_fn(csv,
         }, labels
 
 
+def dense(inputs, units, name):
+    """Fully connected layer computed with a single tf.nn.xw_plus_b op. The
+    variables are named like those of tf.layers.dense (name/kernel and
+    name/bias), so checkpoints stay compatible.
+    arguments:
+       inputs: Input tensor of shape [batch_size, input_units].
+       units: Number of output units.
+       name: Name of the variable scope of the layer.
+    returns: Output tensor of shape [batch_size, units].
+    """
+    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+        kernel = tf.get_variable('kernel', [inputs.shape[-1].value, units])
+        bias = tf.get_variable(
+            'bias', [units], initializer=tf.zeros_initializer())
+        return tf.nn.xw_plus_b(inputs, kernel, bias)
+
+
 def model_fn(mode,
              features,
              labels,
@@ -159,7 +571,8 @@ def model_fn(mode,
              hidden_units=20,
              learning_rate=0.1,
              embedding_size=50,
-             initial_embedding=None):
+             initial_embedding=None,
+             embedding_shards=1):
     """Model function for the sswe network.
     arguments:
        mode: A tf.estimator.ModeKey. One of TRAIN, EVAL, or PREDICT.
@@ -173,18 +586,34 @@ def model_fn(mode,
        learning_rate: Learning rate for AdagradOptimizer.
        embedding_size: Dimensionality of the used embedding.
        initial_embedding: Initial embedding matrix in numpy format.
+       embedding_shards: Number of partitions the embedding matrix is split
+                         into (along the vocabulary).
     returns:
        an EstimatorSpec for creating a tensorflow estimator.
     """
 
     if initial_embedding is not None:
-        init = tf.constant_initializer(initial_embedding)
+
+        def init(shape, dtype=None, partition_info=None):
+            """Initialize the embedding matrix (or one of its partitions)
+            with the corresponding rows of the initial embedding, so that
+            only these rows are copied into the graph."""
+            offset = 0
+            if partition_info is not None:
+                offset = partition_info.var_offset[0]
+            return tf.constant(
+                initial_embedding[offset:offset + shape[0]], dtype=dtype)
     else:
         init = None
 
+    if embedding_shards > 1:
+        partitioner = tf.fixed_size_partitioner(embedding_shards)
+    else:
+        partitioner = None
+
     def shared_network(input):
         """The shared part of the network. Both original and corrupted ngram
-        are passed through here.
+        are passed through here (stacked into a single batch).
         arguments:
            input: Input feature tensor.
         returns: Output of the network (syntactic and sentiment score).
@@ -193,46 +622,54 @@ def model_fn(mode,
         # define embedding variable
         word_embeddings = tf.get_variable(
             'word_embeddings', [vocabulary_size, embedding_size],
-            initializer=init)
+            initializer=init,
+            partitioner=partitioner)
 
         # lookup embeddings for true and negative sample
+        # (partitions hold contiguous ranges of word ids)
         embeds = tf.nn.embedding_lookup(
-            word_embeddings, input, name='embeddings')
-        flattened_embeds = tf.layers.flatten(embeds, name='flattened_embeds')
-
-        hidden = tf.layers.dense(
-            flattened_embeds,
-            hidden_units,
-            activation=
-            lambda x: tf.clip_by_value(x, clip_value_min=-1, clip_value_max=1),
-            name='hidden',
-            reuse=tf.AUTO_REUSE)
-        output = tf.layers.dense(hidden, 2, name='output', reuse=tf.AUTO_REUSE)
+            word_embeddings,
+            input,
+            partition_strategy='div',
+            name='embeddings')
+        flattened_embeds = tf.reshape(
+            embeds, [-1, 3 * embedding_size], name='flattened_embeds')
+
+        hidden = tf.clip_by_value(
+            dense(flattened_embeds, hidden_units, name='hidden'),
+            clip_value_min=-1,
+            clip_value_max=1)
+        output = dense(hidden, 2, name='output')
         return output
 
     with tf.variable_scope('shared_network', reuse=tf.AUTO_REUSE) as scope:
+        # pass original and corrupted ngrams through the network at once
+        stacked_input = tf.reshape(
+            tf.stack([features['original'], features['corrupted']], axis=1),
+            [-1, 3])
+        stacked_output = tf.reshape(
+            shared_network(stacked_input), [-1, 2, 2])
+
         # original ngram output
-        original_output = shared_network(features['original'])
+        original_output = stacked_output[:, 0]
         original_syntactic_score = original_output[:, 0]
         original_sentiment_score = original_output[:, 1]
 
         # corrupted ngram output
-        corrupted_output = shared_network(features['corrupted'])
+        corrupted_output = stacked_output[:, 1]
         corrupted_syntactic_score = corrupted_output[:, 0]
         corrupted_sentiment_score = corrupted_output[:, 1]
 
     if mode == tf.estimator.ModeKeys.TRAIN or mode == tf.estimator.ModeKeys.EVAL:
         with tf.name_scope('loss'):
             sentiment_loss = tf.reduce_mean(
-                tf.maximum(
-                    tf.cast(0, tf.float32),
-                    1 - tf.cast(labels, tf.float32) * original_sentiment_score
-                    + tf.cast(labels, tf.float32) * corrupted_sentiment_score),
+                tf.nn.relu(1 - tf.cast(labels, tf.float32) *
+                           (original_sentiment_score -
+                            corrupted_sentiment_score)),
                 name='sentiment')
             tf.summary.scalar('sentiment_loss', sentiment_loss)
             syntactic_loss = tf.reduce_mean(
-                tf.maximum(
-                    tf.cast(0, tf.float32),
+                tf.nn.relu(
                     1 - original_syntactic_score + corrupted_syntactic_score),
                 name='syntactic')
             tf.summary.scalar('syntactic_loss', syntactic_loss)
@@ -257,6 +694,53 @@ def model_fn(mode,
     return tf.estimator.EstimatorSpec(mode, predictions, loss, train_op)
 
 
+def partition_rows(num_rows, num_shards):
+    """Compute the rows of each partition of a variable that has been split
+    by tf.fixed_size_partitioner. If the rows do not divide evenly, the first
+    partitions hold one row more than the others.
+    arguments:
+       num_rows: Number of rows of the whole variable.
+       num_shards: Number of partitions.
+    returns: List of (offset, rows) tuples, one for each partition.
+    """
+    rows, excess = divmod(num_rows, num_shards)
+    partitions = []
+    offset = 0
+    for shard in range(num_shards):
+        shard_rows = rows + 1 if shard < excess else rows
+        partitions.append((offset, shard_rows))
+        offset += shard_rows
+    return partitions
+
+
+def read_partitions(checkpoint_path, name, num_shards):
+    """Read a matrix variable from a checkpoint one partition at a time.
+    Reading a slice that matches a saved partition only reads that
+    partition, so at most one partition is held in memory.
+    arguments:
+       checkpoint_path: Path (prefix) of the checkpoint.
+       name: Name of the variable in the checkpoint.
+       num_shards: Number of partitions the variable was split into.
+    yields: The rows of one partition after another (numpy arrays).
+    """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    shape = reader.get_variable_to_shape_map()[name]
+    dtype = reader.get_variable_to_dtype_map()[name]
+    with tf.Graph().as_default():
+        slice_spec = tf.placeholder(tf.string, [])
+        restore = tf.raw_ops.RestoreV2(
+            prefix=checkpoint_path,
+            tensor_names=[name],
+            shape_and_slices=tf.reshape(slice_spec, [1]),
+            dtypes=[dtype])[0]
+        with tf.Session() as session:
+            for offset, rows in partition_rows(shape[0], num_shards):
+                yield session.run(restore, {
+                    slice_spec:
+                    '{} {} {},{}:-'.format(shape[0], shape[1], offset, rows)
+                })
+
+
 def main():
     """Create an input parser and then parse the arguments. Setup
     training and model parameters and train model accordingly.
@@ -276,6 +760,11 @@ def main():
         default=None)
     parser.add_argument(
         '--batch_size', default=32, type=int, help='Batchsize for training.')
+    parser.add_argument(
+        '--shuffle_buffer',
+        default=None,
+        type=int,
+        help='Size of the shuffle buffer. Defaults to the number of training samples (at most 1000000), or 100000 when streaming.')
     parser.add_argument(
         '--epochs',
         default=10,
@@ -313,10 +802,31 @@ def main():
     parser.add_argument(
         '--initial_embeddings',
         default=None,
-        help='Initialize the embedding matrix from a csv file.')
+        help='Initialize the embedding matrix from a csv or .npy file.')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream the training data from disk instead of preprocessing it up front. For datasets that do not fit into memory. -data may then also be a directory of csv shards or a glob pattern. Requires --vocabulary or --initial_embeddings.')
+    parser.add_argument(
+        '--processes',
+        default=None,
+        type=int,
+        help='Number of processes used for preprocessing the input data. Defaults to the number of cpus.')
+    parser.add_argument(
+        '--xla',
+        action='store_true',
+        help='Compile the model with XLA (requires tensorflow built with XLA support).')
+    parser.add_argument(
+        '--embedding_shards',
+        default=None,
+        type=int,
+        help='Number of partitions the embedding matrix is split into. Export reads one partition at a time. Defaults to one partition per 100000 words.')
     parser.add_argument(
         '--export_path', default=None, help='Export path to embedding csv.')
     args = parser.parse_args()
+    if args.stream and args.vocabulary is None and args.initial_embeddings is None:
+        # building the vocabulary would read the whole dataset into memory
+        parser.error('--stream requires --vocabulary or --initial_embeddings.')
 
     # Initialize embedding from training data.
     if args.vocabulary is None and args.initial_embeddings is None:
@@ -344,10 +854,18 @@ def main():
         embedding_size = embedding_matrix.shape[1]
     else:
         embedding_size = args.embedding_size
+    if args.embedding_shards is not None:
+        embedding_shards = min(args.embedding_shards, len(vocab))
+    else:
+        embedding_shards = -(-len(vocab) // 100000)
 
     # setup session configuration. Allow gpu growth (do not use all available memory)
     gpu_options = tf.GPUOptions(allow_growth=True)
     session_config = tf.ConfigProto(gpu_options=gpu_options)
+    if args.xla:
+        # let XLA fuse the small dense layers and the losses into few kernels
+        session_config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
     config = tf.estimator.RunConfig(
         model_dir=args.model_dir,
         keep_checkpoint_max=args.keep_checkpoints,
@@ -361,28 +879,48 @@ def main():
                                                              hidden_units=args.hidden,
                                                              learning_rate=args.lr,
                                                              embedding_size=embedding_size,
-                                                             initial_embedding=embedding_matrix)
+                                                             initial_embedding=embedding_matrix,
+                                                             embedding_shards=embedding_shards)
     model = tf.estimator.Estimator(
         model_fn=model_function, model_dir=args.model_dir, config=config)
     model_dir = model.model_dir
 
     # start training
-    model.train(lambda: input_fn(args.data, vocab, num_epochs=args.epochs, batch_size=args.batch_size))
+    iterator_initializer_hook = IteratorInitializerHook()
+    if args.stream:
+        train_input_fn = partial(
+            streaming_input_fn,
+            args.data,
+            vocab,
+            iterator_initializer_hook,
+            num_epochs=args.epochs,
+            batch_size=args.batch_size,
+            shuffle_buffer_size=args.shuffle_buffer or 100000)
+        model.train(train_input_fn, hooks=[iterator_initializer_hook])
+    else:
+        # tri-grams extracted from the training data are cached in the model dir
+        cache_path = join(model_dir,
+                          splitext(basename(args.data))[0] + '.samples.npz')
+        train_input_fn = partial(
+            input_fn,
+            args.data,
+            vocab,
+            num_epochs=args.epochs,
+            batch_size=args.batch_size,
+            shuffle_buffer_size=args.shuffle_buffer,
+            cache_path=cache_path,
+            processes=args.processes,
+            iterator_initializer_hook=iterator_initializer_hook)
+        model.train(train_input_fn, hooks=[iterator_initializer_hook])
 
     # export the embedding as csv
     if args.export_path is not None:
-        graph_path = [
-            join(model_dir, meta_graph) for meta_graph in listdir(model_dir)
-            if meta_graph.endswith('.meta')
-        ][0]
-        with tf.Session() as sess:
-            saver = tf.train.import_meta_graph(graph_path)
-            saver.restore(sess, tf.train.latest_checkpoint(model_dir))
-            embedding_matrix = sess.run('shared_network/word_embeddings:0')
-        embedding = Embedding(size=args.embedding_size)
-        embedding.embedding_matrix = embedding_matrix
-        embedding.vocabulary = vocab
-        embedding.save(args.export_path)
+        # write the embedding matrix partition by partition
+        partitions = read_partitions(
+            tf.train.latest_checkpoint(model_dir),
+            'shared_network/word_embeddings', embedding_shards)
+        save_embedding_chunks(vocab, partitions,
+                              (len(vocab), embedding_size), args.export_path)
 
 
 if __name__ == '__main__':
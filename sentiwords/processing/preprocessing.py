@@ -51,13 +51,25 @@ class Preprocessor():
         arguments:
            tweet: The input tweet (a String)
         """
-        tweet = unescape(tweet)
-        tokens = self.tokenizer.tokenize(tweet)
-        tokens = map(lambda x: x.replace('#', ''), tokens)
-        tokens = (self.__maybe_replace_with_token(word) for word in tokens)
-        tokens = filter(lambda x: x not in self.stopwords, tokens)
-        tokens = map(lambda x: x.replace(' ', ''), tokens)
-        return list(tokens)
+        return self.tokenize_batch([tweet])[0]
+
+    def tokenize_batch(self, tweets):
+        """Tokenizes a batch of tweets according to the preprocessors
+        parameters. The per tweet setup is hoisted out of the loop, so this
+        is faster than calling tokenize_tweet on every tweet.
+        arguments:
+           tweets: Iterable of input tweets (Strings).
+        returns: A list of tokens for each input tweet.
+        """
+        tokenize = self.tokenizer.tokenize
+        maybe_replace = self.__maybe_replace_with_token
+        stopwords = set(self.stopwords)
+        return [[
+            token.replace(' ', '')
+            for token in (maybe_replace(word.replace('#', ''))
+                          for word in tokenize(unescape(tweet)))
+            if token not in stopwords
+        ] for tweet in tweets]
 
     def __maybe_replace_with_token(self, word):
         """Maybe replaces a word with a matching token.
@@ -85,7 +97,8 @@ class Preprocessor():
         returns: A list of preprocessed tokens for each input tweet.
         """
         df = pd.read_csv(csv, sep=',', header=None, names=columns)
-        df['tokens'] = df['text'].apply(self.tokenize_tweet)
+        df['tokens'] = pd.Series(
+            self.tokenize_batch(df['text']), index=df.index)
         return df['tokens'].values
 
 